@@ -76,7 +76,8 @@ class LambdaIngestStack(Stack):
                     self,
                     f"{env_name}",
                     'ingest',
-                    Path('../requirements.txt')
+                    Path('../requirements.txt'),
+                    Path('../requirements_optional.txt'),
                 ),
             ],
         )
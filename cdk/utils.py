@@ -17,7 +17,8 @@ def create_dependencies_layer(
         self,
         env_name: str,
         function_name: str,
-        requirements_path: Path
+        requirements_path: Path,
+        optional_requirements_path: Path = None,
 ) -> aws_lambda.LayerVersion:
     requirements_file = str(requirements_path.resolve())
     output_dir = f'../.build/{function_name}'
@@ -25,9 +26,20 @@ def create_dependencies_layer(
 
     if not environ.get('SKIP_PIP'):
         print(f'Building {layer_id} from {requirements_file} into {output_dir}')
+        optional_install = ''
+        if optional_requirements_path is not None:
+            # optional packages only speed things up and the code falls
+            # back when they are missing, so a failed install is not fatal
+            optional_file = str(optional_requirements_path.resolve())
+            optional_install = (
+                f"(python -m pip install -qq -r {optional_file} "
+                f"-t {output_dir}/python || "
+                f"echo 'Skipping optional packages from {optional_file}') &&"
+            )
         subprocess.run(
             f"""python -m pip install -qq -r {requirements_file} \
             -t {output_dir}/python && \
+            {optional_install} \
             cd {output_dir}/python && \
             find . -type f -name '*.pyc' | \
               while read f; do n=$(echo $f | \
@@ -2,6 +2,7 @@ import argparse
 import logging
 import os
 import sys
+import shutil
 import orjson
 import psycopg2
 
@@ -112,15 +113,14 @@ from ingest.utils import (
 def check_realtime_key(key: str, fix: bool = False):
     """Check realtime file for common errors"""
     logger.debug(f"\n## Checking realtime for issues: {key}")
-    # get text of object
+    # get the lines of the object
     try:
-        txt = get_object(key)
+        with get_object(key) as f:
+            lines = [line.rstrip(b"\n") for line in f]
     except Exception as e:
         # these errors are not fixable so return
         logger.error(f"\t*** Error getting file: {e}")
         return;
-    # break into lines
-    lines = txt.split("\n")
     # check parse for each line
     n = len(lines)
     errors = []
@@ -131,20 +131,20 @@ def check_realtime_key(key: str, fix: bool = False):
                 obj = orjson.loads(line)
             except Exception as e:
                 errors.append(jdx)
-                print(f"*** Loading error on line #{jdx} (of {n}): {e}\n{line}")
+                print(f"*** Loading error on line #{jdx} (of {n}): {e}\n{line.decode(errors='replace')}")
             try:
                 # then we can try to parse it
                 parse_json(obj)
             except Exception as e:
                 errors.append(jdx)
-                print(f"*** Parsing error on line #{jdx} (of {n}): {e}\n{line}")
+                print(f"*** Parsing error on line #{jdx} (of {n}): {e}\n{line.decode(errors='replace')}")
 
     if len(errors) > 0 and fix:
         # remove the bad rows and then replace the file
         nlines = [l for i, l in enumerate(lines) if i not in errors]
         message = f"Fixed: removed {len(errors)} and now have {len(nlines)} lines"
         print(message)
-        ntext = "\n".join(nlines)
+        ntext = b"".join(l + b"\n" for l in nlines).decode("utf-8")
         put_object(
             data=ntext,
             key=key
@@ -178,11 +178,10 @@ if args.id is not None:
             p = deconstruct_path(key)
             download_path = f'~/Downloads/{p["bucket"]}/{p["key"]}';
             logger.info(f'downloading to {download_path}')
-            txt = get_object(**p)
             fpath = os.path.expanduser(download_path)
             os.makedirs(os.path.dirname(fpath), exist_ok=True)
-            with open(fpath.replace('.gz', ''), 'w') as f:
-                f.write(txt)
+            with get_object(**p) as txt, open(fpath.replace('.gz', ''), 'wb') as f:
+                shutil.copyfileobj(txt, f)
         # if we are resubmiting we dont care
         # what type of file it is
         elif args.resubmit:
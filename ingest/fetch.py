@@ -1,4 +1,3 @@
-import gzip
 import io
 import os
 import logging
@@ -16,6 +15,8 @@ from .utils import (
     clean_csv_value,
     get_query,
     get_data,
+    INGEST_OPTIONS,
+    gzip_open,
     load_fail,
     load_success,
     load_fetchlogs,
@@ -28,7 +29,6 @@ dir_path = os.path.dirname(os.path.realpath(__file__))
 logger = logging.getLogger('fetch')
 
 FETCH_BUCKET = settings.FETCH_BUCKET
-s3 = boto3.resource("s3")
 
 
 def parse_json(j, key: str = None):
@@ -137,7 +137,7 @@ def copy_data(cursor, key, fetchlogsId=None):
 
 
 def copy_file(cursor, file):
-    with gzip.GzipFile(file) as gz:
+    with gzip_open(file, 'rb') as gz:
         f = io.BufferedReader(gz)
         iterator = StringIteratorIO(
             (parse_json(orjson.loads(line)) for line in f)
@@ -293,7 +293,7 @@ def load_db(limit: int = 50, ascending: bool = False):
             load_realtime(rows)
         except Exception as e:
             # catch and continue to next page
-            ids = [r[2] for r in rows]
+            ids = [r[0] for r in rows]
             logger.error(f"""
             Error processing realtime files: {e}, {ids}
             """)
@@ -308,7 +308,10 @@ def load_realtime(rows):
     log_time = -1
     process_time = -1
     copy_time = 0
-    with psycopg2.connect(settings.DATABASE_WRITE_URL) as connection:
+    with psycopg2.connect(
+        settings.DATABASE_WRITE_URL,
+        options=INGEST_OPTIONS,
+    ) as connection:
         connection.set_session(autocommit=True)
         with connection.cursor() as cursor:
             # create all the data staging table
@@ -5,7 +5,8 @@ from .settings import settings
 from .lcs import load_metadata_db
 from .lcsV2 import load_measurements_db
 from .fetch import load_db
-from time import time
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
 import json
 
 from datetime import datetime, timezone
@@ -109,7 +110,7 @@ def cronhandler(event, context):
         logger.info('Ingesting is paused')
         return None
 
-    start_time = time()
+    start_time = monotonic()
     timeout = settings.INGEST_TIMEOUT  # manual timeout for testing
     ascending = settings.FETCH_ASCENDING if 'ascending' not in event else event['ascending']
     pipeline_limit = settings.PIPELINE_LIMIT if 'pipeline_limit' not in event else event['pipeline_limit']
@@ -122,55 +123,74 @@ def cronhandler(event, context):
     # unaccounted for happens we can still move on to the next
     # process. In case of this type of exception we will need to
     # fix it asap
-    try:
-        if metadata_limit > 0:
-            cnt = 0
-            loaded = 1
-            while (
-                    loaded > 0
-                    and (time() - start_time) < timeout
-            ):
-                loaded = load_metadata_db(metadata_limit, ascending)
-                cnt += loaded
-                logger.info(
-                    "loaded %s metadata records, timer: %0.4f",
-                    cnt, time() - start_time
-                )
-    except Exception as e:
-        logger.error(f"load metadata failed: {e}")
-
-    try:
-        if realtime_limit > 0:
-            cnt = 0
-            loaded = 1
-            while (
-                    loaded > 0
-                    and (time() - start_time) < timeout
-            ):
-                loaded = load_db(realtime_limit, ascending)
-                cnt += loaded
-                logger.info(
-                    "loaded %s fetch records, timer: %0.4f",
-                    cnt, time() - start_time
+    def load_lcs():
+        # the pipeline files can reference nodes from the metadata
+        # files and both use the staging_* tables so these two
+        # still run one after the other
+        try:
+            if metadata_limit > 0:
+                run_loader(
+                    load_metadata_db, metadata_limit, ascending,
+                    "metadata", start_time, timeout
                 )
-    except Exception as e:
-        logger.error(f"load realtime failed: {e}")
-
-    try:
-        if pipeline_limit > 0:
-            cnt = 0
-            loaded = 1
-            while (
-                    loaded > 0
-                    and (time() - start_time) < timeout
-            ):
-                loaded = load_measurements_db(pipeline_limit, ascending)
-                cnt += loaded
-                logger.info(
-                    "loaded %s pipeline records, timer: %0.4f",
-                    cnt, time() - start_time
+        except Exception as e:
+            logger.error(f"load metadata failed: {e}")
+
+        try:
+            if pipeline_limit > 0:
+                run_loader(
+                    load_measurements_db, pipeline_limit, ascending,
+                    "pipeline", start_time, timeout
                 )
-    except Exception as e:
-        logger.error(f"load pipeline failed: {e}")
+        except Exception as e:
+            logger.error(f"load pipeline failed: {e}")
 
-    logger.info("done processing: %0.4f seconds", time() - start_time)
+    def load_realtime():
+        # the realtime files only touch the tempfetchdata tables
+        # so they can be loaded alongside the lcs files
+        try:
+            if realtime_limit > 0:
+                run_loader(
+                    load_db, realtime_limit, ascending,
+                    "fetch", start_time, timeout
+                )
+        except Exception as e:
+            logger.error(f"load realtime failed: {e}")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        executor.submit(load_lcs)
+        executor.submit(load_realtime)
+
+    logger.info("done processing: %0.4f seconds", monotonic() - start_time)
+
+
+def run_loader(loader, limit, ascending, name, start_time, timeout):
+    """
+    Call the loader until there is nothing left to load or we run out of
+    time. The batch size is scaled down near the deadline using a moving
+    average of the time it has taken to load each file
+    """
+    cnt = 0
+    loaded = 1
+    deadline = start_time + timeout
+    per_file = None
+    now = monotonic()
+    while (
+            loaded > 0
+            and now < deadline
+    ):
+        batch = limit
+        if per_file:
+            batch = min(limit, max(1, int((deadline - now) / per_file)))
+        loaded = loader(batch, ascending)
+        took = monotonic() - now
+        now += took
+        if loaded > 0:
+            rate = took / loaded
+            per_file = rate if per_file is None else 0.8 * per_file + 0.2 * rate
+        cnt += loaded
+        logger.info(
+            "loaded %s %s records, timer: %0.4f",
+            cnt, name, now - start_time
+        )
+    return cnt
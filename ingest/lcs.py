@@ -13,17 +13,17 @@ import warnings
 import boto3
 import psycopg2
 import typer
-from io import StringIO
 from .settings import settings
 from .utils import (
     get_query,
     clean_csv_value,
     StringIteratorIO,
     fix_units,
+    write_csv,
     load_fetchlogs,
+    INGEST_OPTIONS,
 )
 
-s3 = boto3.resource("s3")
 s3c = boto3.client("s3")
 
 app = typer.Typer()
@@ -165,7 +165,10 @@ class LCSData:
 
     def load_data(self):
         logger.debug(f"load_data: {self.keys}, {self.nodes}")
-        with psycopg2.connect(settings.DATABASE_WRITE_URL) as connection:
+        with psycopg2.connect(
+            settings.DATABASE_WRITE_URL,
+            options=INGEST_OPTIONS,
+        ) as connection:
             connection.set_session(autocommit=True)
             with connection.cursor() as cursor:
                 start_time = time()
@@ -290,21 +293,6 @@ def create_staging_table(cursor):
 		table="TEMP TABLE" if settings.USE_TEMP_TABLES else 'TABLE'
 	))
 
-def write_csv(cursor, data, table, columns):
-    fields = ",".join(columns)
-    sio = StringIO()
-    writer = csv.DictWriter(sio, columns)
-    writer.writerows(data)
-    sio.seek(0)
-    cursor.copy_expert(
-        f"""
-        copy {table} ({fields}) from stdin with csv;
-        """,
-        sio,
-    )
-    logger.debug(f"table: {table}; rowcount: {cursor.rowcount}")
-
-
 def load_metadata_bucketscan(count=100):
     paginator = s3c.get_paginator("list_objects_v2")
     for page in paginator.paginate(
@@ -394,6 +382,7 @@ def select_object(key):
         compression = "NONE"
     try:
         content = ""
+        chunks = []
         resp = s3c.select_object_content(
             Bucket=settings.ETL_BUCKET,
             Key=key,
@@ -411,7 +400,8 @@ def select_object(key):
         )
         for event in resp["Payload"]:
             if "Records" in event:
-                content += event["Records"]["Payload"].decode("utf-8")
+                chunks.append(event["Records"]["Payload"])
+        content = b"".join(chunks).decode("utf-8")
     except Exception as e:
         submit_file_error(key, e)
     return content
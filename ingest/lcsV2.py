@@ -1,32 +1,52 @@
+import io
 import os
+import sys
 import logging
+import threading
+import struct
 from datetime import datetime, timezone
 import dateparser
 import pytz
 import orjson
 import uuid
 import csv
+from collections import deque
+from contextlib import closing
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 from urllib.parse import unquote_plus
 import warnings
-import re
+
+try:
+    # simdjson uses a SIMD structural index and is faster than orjson
+    # for the larger json files, the parser is reused to keep its buffers
+    import simdjson
+except ImportError:
+    simdjson = None
+
+# a simdjson parser is not thread safe so every thread that loads keys
+# keeps its own parser
+_parsers = threading.local()
 
 import boto3
 import psycopg2
 import typer
-from io import StringIO
 from .settings import settings
 from .utils import (
     get_query,
-    clean_csv_value,
-    StringIteratorIO,
+    pipe_reader,
     fix_units,
+    write_csv,
     load_fetchlogs,
     select_object,
     get_file,
+    CSV_SUFFIXES,
+    JSON_SUFFIXES,
+    NDJSON_SUFFIXES,
+    INGEST_OPTIONS,
 )
 
-s3 = boto3.resource("s3")
 s3c = boto3.client("s3")
 
 app = typer.Typer()
@@ -36,22 +56,63 @@ FETCH_BUCKET = settings.ETL_BUCKET
 
 logger = logging.getLogger(__name__)
 
+
+def loads(content):
+    """Parse json content using simdjson when available"""
+    if simdjson is None:
+        return orjson.loads(content)
+    parser = getattr(_parsers, "parser", None)
+    if parser is None:
+        parser = _parsers.parser = simdjson.Parser()
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    # a recursive parse returns plain python objects instead of
+    # proxies that the next parse on this parser would invalidate
+    return parser.parse(content, True)
+
 warnings.filterwarnings(
     "ignore",
     message="The localize method is no longer necessary, as this time zone supports the fold attribute",
 )
 
 
+def open_key(key):
+    """Open a fetchlogs key for reading, csv files are opened as text"""
+    # is it a local file? This is used for dev
+    # but likely fine to leave in
+    if os.path.exists(key):
+        f = get_file(key)
+        if key.endswith(".csv.gz"):
+            f = io.TextIOWrapper(f, encoding="utf-8")
+        return f
+    return io.StringIO(select_object(key))
+
+
+def dispatch_table(mp):
+    """Flatten a key map into key -> (col, func) so process can unpack it"""
+    return {k: (m.get('col', k), m.get('func')) for k, m in mp.items()}
+
+
+def close_key(future):
+    """Close a file opened by open_key in the background that was not loaded"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
 def to_geometry(key, data):
-    # could be passed as lat/lng or coordinates
-    if key in ['lat','lon']:
-        lat = data.get('lat')
-        lon = data.get('lon')
-    elif key == 'coordinates':
-        lat = data.get('coordinates', {}).get('lat')
-        lon = data.get('coordinates', {}).get('lon')
-    if None in [lat, lon]:
-        raise Exception('Missing value for coordinates')
+    # could be passed as lat/lon or nested under coordinates/geometry
+    if key in ['lat', 'lon']:
+        c = data
+    else:
+        c = data.get(key) or {}
+    lat = c.get('lat')
+    if lat is None:
+        lat = c.get('latitude')
+    lon = c.get('lon')
+    if lon is None:
+        lon = c.get('longitude')
+    if lat is None or lon is None:
+        raise Exception(f'Missing value for {key}')
     # could add more checks
     return f"SRID=4326;POINT({lon} {lat})"
 
@@ -68,9 +129,27 @@ def to_timestamp(key, data):
         else:
             dt = datetime.fromtimestamp(int(dt), timezone.utc)
     else:
-        dt = dateparser.parse(dt).replace(tzinfo=timezone.utc)
+        # most of the timestamps are iso formatted so try the much
+        # faster fromisoformat before falling back to dateparser
+        try:
+            dt = datetime.fromisoformat(
+                dt[:-1] + '+00:00' if dt.endswith('Z') else dt
+            )
+        except ValueError:
+            dt = dateparser.parse(dt)
+        dt = dt.replace(tzinfo=timezone.utc)
+
+    return dt
+
 
-    return dt.isoformat()
+def connect_ingest():
+    """Open an autocommit connection with the ingest session options"""
+    connection = psycopg2.connect(
+        settings.DATABASE_WRITE_URL,
+        options=INGEST_OPTIONS,
+    )
+    connection.set_session(autocommit=True)
+    return connection
 
 
 class IngestClient:
@@ -84,7 +163,8 @@ class IngestClient:
         self.sensors = []
         self.systems = []
         self.nodes = []
-        self.node_ids = {}
+        self.node_ids = set()
+        self.system_ids = set()
         self.measurements = []
         self.matching_method = 'ingest-id'
         self.source = None
@@ -113,6 +193,9 @@ class IngestClient:
             "lat": {},
             "lon": {},
             }
+        # flattened versions of the maps used by process
+        self.node_dispatch = dispatch_table(self.node_map)
+        self.measurement_dispatch = dispatch_table(self.measurement_map)
         # if fetchlogs_id but no key or data
         # get key
         # if key, load data
@@ -120,20 +203,16 @@ class IngestClient:
         if data is not None and isinstance(data, dict):
             self.load(data)
 
-    def process(self, key, data, mp):
-        col = None
-        value = None
-        m = mp.get(key)
-        if m is not None:
-            col = m.get('col', key)
-            func = m.get('func')
-            if func is None:
-                # just return value
-                value = data.get(key)
-            else:
-                # functions require key and data
-                value = func(key, data)
-        return col, value
+    def process(self, key, data, dispatch):
+        m = dispatch.get(key)
+        if m is None:
+            return None, None
+        col, func = m
+        if func is None:
+            # just return value
+            return col, data.get(key)
+        # functions require key and data
+        return col, func(key, data)
 
     def dump(self):
         """
@@ -143,147 +222,151 @@ class IngestClient:
         need to run the dump method to get the file to be marked as finished
         """
         logger.debug(f"Dumping data from {len(self.keys)} files")
-        if len(self.nodes)>0 or len(self.keys)>0:
-            self.dump_locations()
-        if len(self.measurements)>0 or len(self.keys)>0:
-            self.dump_measurements()
-
-    def dump_locations(self):
+        # share one connection for the locations and measurements
+        with closing(connect_ingest()) as connection:
+            if len(self.nodes)>0 or len(self.keys)>0:
+                self.dump_locations(connection)
+            if len(self.measurements)>0 or len(self.keys)>0:
+                self.dump_measurements(connection)
+
+    def dump_locations(self, connection=None):
         """
         Dump the nodes into the temporary tables
         """
+        if connection is None:
+            with closing(connect_ingest()) as connection:
+                return self.dump_locations(connection)
+
         logger.debug(f"Dumping {len(self.nodes)} nodes")
-        with psycopg2.connect(settings.DATABASE_WRITE_URL) as connection:
-            connection.set_session(autocommit=True)
-            with connection.cursor() as cursor:
-                start_time = time()
-
-                cursor.execute(get_query(
-                    "temp_locations_dump.sql",
-                    table="TEMP TABLE" if settings.USE_TEMP_TABLES else "TABLE"
-                ))
-
-                write_csv(
-                    cursor,
-                    self.keys,
-                    f"staging_keys",
-                    [
-                        "key",
-                        "last_modified",
-                        "fetchlogs_id",
-                    ],
-                )
-                # update by id instead of key due to matching issue
-                cursor.execute(
-                    """
-                    UPDATE fetchlogs
-                    SET loaded_datetime = clock_timestamp()
-                    , last_message = 'load_data'
-                    WHERE fetchlogs_id IN (SELECT fetchlogs_id FROM staging_keys)
-                    """
-                )
-                connection.commit()
+        with connection.cursor() as cursor:
+            start_time = time()
+
+            cursor.execute(get_query(
+                "temp_locations_dump.sql",
+                table="TEMP TABLE" if settings.USE_TEMP_TABLES else "TABLE"
+            ))
+
+            write_csv(
+                cursor,
+                self.keys,
+                f"staging_keys",
+                [
+                    "key",
+                    "last_modified",
+                    "fetchlogs_id",
+                ],
+            )
+            # update by id instead of key due to matching issue
+            cursor.execute(
+                """
+                UPDATE fetchlogs
+                SET loaded_datetime = clock_timestamp()
+                , last_message = 'load_data'
+                WHERE fetchlogs_id IN (SELECT fetchlogs_id FROM staging_keys)
+                """
+            )
+            connection.commit()
+
+            write_csv(
+                cursor,
+                self.nodes,
+                "staging_sensornodes",
+                [
+                    "ingest_id",
+                    "site_name",
+                    "matching_method",
+                    "source_name",
+                    "source_id",
+                    "ismobile",
+                    "geom",
+                    "metadata",
+                    "fetchlogs_id",
+                ],
+            )
 
-                write_csv(
-                    cursor,
-                    self.nodes,
-                    "staging_sensornodes",
-                    [
-                        "ingest_id",
-                        "site_name",
-                        "matching_method",
-                        "source_name",
-                        "source_id",
-                        "ismobile",
-                        "geom",
-                        "metadata",
-                        "fetchlogs_id",
-                    ],
-                )
+            write_csv(
+                cursor,
+                self.systems,
+                "staging_sensorsystems",
+                [
+                    "ingest_id",
+                    "ingest_sensor_nodes_id",
+                    "metadata",
+                    "fetchlogs_id",
+                ],
+            )
+            write_csv(
+                cursor,
+                self.sensors,
+                "staging_sensors",
+                [
+                    "ingest_id",
+                    "ingest_sensor_systems_id",
+                    "measurand",
+                    "units",
+                    "metadata",
+                    "fetchlogs_id",
+                ],
+            )
+            connection.commit()
 
-                write_csv(
-                    cursor,
-                    self.systems,
-                    "staging_sensorsystems",
-                    [
-                        "ingest_id",
-                        "ingest_sensor_nodes_id",
-                        "metadata",
-                        "fetchlogs_id",
-                    ],
-                )
-                write_csv(
-                    cursor,
-                    self.sensors,
-                    "staging_sensors",
-                    [
-                        "ingest_id",
-                        "ingest_sensor_systems_id",
-                        "measurand",
-                        "units",
-                        "metadata",
-                        "fetchlogs_id",
-                    ],
-                )
-                connection.commit()
+            # and now we load all the nodes,systems and sensors
+            query = get_query("etl_process_nodes.sql")
+            cursor.execute(query)
 
-                # and now we load all the nodes,systems and sensors
-                query = get_query("etl_process_nodes.sql")
-                cursor.execute(query)
+            for notice in connection.notices:
+                logger.debug(notice)
 
-                for notice in connection.notices:
-                    logger.debug(notice)
+            cursor.execute(
+                """
+                UPDATE fetchlogs
+                SET completed_datetime = clock_timestamp()
+                , last_message = NULL
+                WHERE fetchlogs_id IN (SELECT fetchlogs_id FROM staging_keys)
+                """
+            )
 
-                cursor.execute(
-                    """
-                    UPDATE fetchlogs
-                    SET completed_datetime = clock_timestamp()
-                    , last_message = NULL
-                    WHERE fetchlogs_id IN (SELECT fetchlogs_id FROM staging_keys)
-                    """
-                )
+            connection.commit()
+            logger.info("dump_locations: locations: %s; time: %0.4f", len(self.nodes), time() - start_time)
+            for notice in connection.notices:
+                logger.debug(notice)
 
-                connection.commit()
-                logger.info("dump_locations: locations: %s; time: %0.4f", len(self.nodes), time() - start_time)
-                for notice in connection.notices:
-                    logger.debug(notice)
 
+    def dump_measurements(self, connection=None):
+        if connection is None:
+            with closing(connect_ingest()) as connection:
+                return self.dump_measurements(connection)
 
-    def dump_measurements(self):
         logger.debug(f"Dumping {len(self.measurements)} measurements")
-        with psycopg2.connect(settings.DATABASE_WRITE_URL) as connection:
-            connection.set_session(autocommit=True)
-            with connection.cursor() as cursor:
-                start_time = time()
-
-                cursor.execute(get_query(
-                    "temp_measurements_dump.sql",
-                    table="TEMP TABLE" if settings.USE_TEMP_TABLES else 'TABLE'
-                ))
-
-                iterator = StringIteratorIO(
-                    (to_tsv(line) for line in self.measurements)
-                )
+        with connection.cursor() as cursor:
+            start_time = time()
+
+            cursor.execute(get_query(
+                "temp_measurements_dump.sql",
+                table="TEMP TABLE" if settings.USE_TEMP_TABLES else 'TABLE'
+            ))
+
+            with pipe_reader(to_copy_binary(self.measurements), "rb") as f:
                 cursor.copy_expert(
                     """
                     COPY staging_measurements (ingest_id, source_name, source_id, measurand, value, datetime, lon, lat, fetchlogs_id)
-                    FROM stdin;
+                    FROM stdin WITH (FORMAT binary);
                     """,
-                    iterator,
+                    f,
                 )
 
-                # process the measurements
-                logger.info(f'processing {len(self.measurements)} measurements');
-                query = get_query("etl_process_measurements.sql")
-                try:
-                    cursor.execute(query)
-                    connection.commit()
-                    logger.info("dump_measurements: measurements: %s; time: %0.4f", len(self.measurements), time() - start_time)
-                    for notice in connection.notices:
-                        logger.debug(notice)
+            # process the measurements
+            logger.info(f'processing {len(self.measurements)} measurements');
+            query = get_query("etl_process_measurements.sql")
+            try:
+                cursor.execute(query)
+                connection.commit()
+                logger.info("dump_measurements: measurements: %s; time: %0.4f", len(self.measurements), time() - start_time)
+                for notice in connection.notices:
+                    logger.debug(notice)
 
-                except Exception as err:
-                    logger.error(err)
+            except Exception as err:
+                logger.error(err)
 
     def load(self, data = {}):
         if "meta" in data.keys():
@@ -293,40 +376,64 @@ class IngestClient:
         if "measures" in data.keys():
             self.load_measurements(data.get('measures'))
 
-    def load_keys(self, rows):
-        # for each fetchlog we need to read and load
-        for row in rows:
-            key = row[1]
-            fetchlogs_id = row[0]
-            last_modified = row[2]
-            self.load_key(key, fetchlogs_id, last_modified)
+    def load_keys(self, rows, read_ahead: int = 8):
+        # for each fetchlog we need to read and load, the next few
+        # objects are downloaded in the background while the earlier
+        # ones are being parsed
+        executor = ThreadPoolExecutor(max_workers=read_ahead)
+        rows = iter(rows)
+        pending = deque(
+            (row, executor.submit(open_key, row[1]))
+            for row in islice(rows, read_ahead)
+        )
+        try:
+            while pending:
+                row, future = pending.popleft()
+                f = future.result()
+                # keep the window full before parsing this one
+                for nxt in islice(rows, 1):
+                    pending.append((nxt, executor.submit(open_key, nxt[1])))
+                key = row[1]
+                fetchlogs_id = row[0]
+                last_modified = row[2]
+                self.load_key(key, fetchlogs_id, last_modified, f)
+        except Exception:
+            # do not wait on downloads we will never use and close
+            # anything that was already opened
+            for _, future in pending:
+                if not future.cancel():
+                    future.add_done_callback(close_key)
+            raise
+        finally:
+            executor.shutdown(wait=False)
 
 
-    def load_key(self, key, fetchlogs_id, last_modified):
+    def load_key(self, key, fetchlogs_id, last_modified, f=None):
         logger.debug(f"Loading key: {fetchlogs_id}//:{key}")
-        is_csv = bool(re.search(r"\.csv(.gz)?$", key))
-        is_json = bool(re.search(r"\.(nd)?json(.gz)?$", key))
+        is_csv = key.endswith(CSV_SUFFIXES)
+        is_json = key.endswith(JSON_SUFFIXES)
         self.fetchlogs_id = fetchlogs_id
 
-        # is it a local file? This is used for dev
-        # but likely fine to leave in
-        if os.path.exists(key):
-            content = get_file(key).read()
-        else:
-            content = select_object(key)
-
-        logger.debug(f"Read content containing {len(content)} lines")
-
-        if is_csv:
-            # all csv data will be measurements
-            for rw in csv.reader(content.split("\n")):
-                self.add_measurement(rw)
-        elif is_json:
-            # all json data should just be parsed and loaded
-            data = orjson.loads(content)
-            self.load(data)
-        else:
-            raise Exception('No idea what to do')
+        if f is None:
+            f = open_key(key)
+
+        with f:
+            if is_csv:
+                # all csv data will be measurements, the rows are read
+                # a line at a time rather than splitting the whole file
+                for rw in csv.reader(f):
+                    self._add_measurement_from_row(rw)
+            elif key.endswith(NDJSON_SUFFIXES):
+                # one json document per line
+                for line in f:
+                    if line.strip():
+                        self.load(loads(line))
+            elif is_json:
+                # all json data should just be parsed and loaded
+                data = loads(f.read())
+                self.load(data)
+            else:
+                raise Exception('No idea what to do')
 
         # add the key to the table to update
         self.keys.append({"key": key, "last_modified": last_modified, "fetchlogs_id": fetchlogs_id})
@@ -385,18 +492,21 @@ class IngestClient:
                     self.add_sensor(value, id, fetchlogsId)
                 else:
                     metadata[key] = value
-            system["metadata"] = orjson.dumps(metadata).decode()
-            self.systems.append(system)
+            # the staging table requires unique system ids but the
+            # sensors of a repeated system still need to be added
+            if id not in self.system_ids:
+                self.system_ids.add(id)
+                system["metadata"] = orjson.dumps(metadata).decode()
+                self.systems.append(system)
 
     def add_node(self, j):
         fetchlogs_id = j.get('fetchlogs_id', self.fetchlogs_id)
         node = { "fetchlogs_id": fetchlogs_id }
         metadata = {}
-        mp = self.node_map
 
         for k, v in j.items():
             # pass the whole measure
-            col, value = self.process(k, j, self.node_map)
+            col, value = self.process(k, j, self.node_dispatch)
             if col is not None:
                 node[col] = value
             else:
@@ -409,13 +519,19 @@ class IngestClient:
             if ingest_id is None:
                 raise Exception('Missing ingest id')
 
-            ingest_arr = ingest_id.split('-')
+            source_name, sep, rest = ingest_id.partition('-')
+            # existing sensor nodes were stored with only the segment
+            # after the source name as their source_id and are matched
+            # on (source_name, source_id) so a source id that contains
+            # dashes is still cut at the first one until those stored
+            # ids are migrated
+            source_id = rest.partition('-')[0]
             # source name could be set explicitly
             # or in the ingest id
             # or in the metadata
             if node.get('source_name') is None:
-                if len(ingest_arr)>1:
-                    node['source_name'] = ingest_arr[0]
+                if sep:
+                    node['source_name'] = source_name
                 elif self.source is not None:
                     node['source_name'] = self.source
                 else:
@@ -423,10 +539,10 @@ class IngestClient:
 
             # support ingest id that is just the source id
             if node.get('source_id') is None:
-                if len(ingest_arr)>1:
-                    node['source_id'] = ingest_arr[1]
+                if sep:
+                    node['source_id'] = source_id
                 else:
-                    node['source_id'] = ingest_arr[0]
+                    node['source_id'] = ingest_id
 
             if node.get('matching_method') is None:
                 node['matching_method'] = self.matching_method
@@ -436,11 +552,14 @@ class IngestClient:
             # logger.debug(node)
             if ingest_id not in self.node_ids:
                 node["metadata"] = orjson.dumps(metadata).decode()
-                self.node_ids[ingest_id] = True
+                self.node_ids.add(ingest_id)
                 self.nodes.append(node)
             # now look for systems
             if "sensor_system" in j.keys():
-                self.system(j.get('sensor_system'), node.get('ingest_id'), node.get('fetchlogs_id'))
+                systems = j.get('sensor_system')
+                if isinstance(systems, dict):
+                    systems = [systems]
+                self.add_system(systems, node.get('ingest_id'), node.get('fetchlogs_id'))
         else:
             logger.warning('nothing mapped to node')
 
@@ -449,50 +568,68 @@ class IngestClient:
         # create a row with
         # ingest_id,datetime,value,lon,lat
         # where ingest id will be what links to the sensor
-        meas = {}
+        if isinstance(m, list):
+            self._add_measurement_from_row(m)
+        elif isinstance(m, dict):
+            self._add_measurement_from_dict(m)
+        else:
+            logger.warning(f'Unknown measurement type: {m}')
+
+    def _add_measurement_from_row(self, m):
+        # csv method
+        if len(m) < 3:
+            logger.warning(f'Not enough data in list value: {m}')
+            return
+
         lat = None
         lon = None
+        ingest_id = m[0]
+        value = m[1]
+        # using the same key/data format as the dict method
+        datetime = to_timestamp('dt', {"dt": m[2]})
+        if len(m) == 5:
+            lat = m[3]
+            lon = m[4]
 
-        # csv method
-        if isinstance(m, list):
-            if len(m) < 3:
-                logger.warning(f'Not enough data in list value: {m}')
-                return
-
-            fetchlogs_id = self.fetchlogs_id
-            ingest_id = m[0]
-            value = m[1]
-            # using the same key/data format as below
-            datetime = to_timestamp('dt', {"dt": m[2]})
-            if len(m) == 5:
-                lat = m[3]
-                lon = m[4]
+        self._append_measurement(ingest_id, value, datetime, lon, lat, self.fetchlogs_id)
 
-        elif isinstance(m, dict):
-            for k, v in m.items():
-                # pass the whole measure
-                col, value = self.process(k, m, self.measurement_map)
-                if col is not None:
-                    meas[col] = value
-
-            ingest_id = meas.get('ingest_id')
-            datetime = meas.get('datetime')
-            value = meas.get('value')
-            lon = meas.get('lon', None)
-            lat = meas.get('lat', None)
-            fetchlogs_id = m.get('fetchlogs_id', self.fetchlogs_id)
-
-        # parse the ingest id here
-        ingest_arr = ingest_id.split('-')
-        if len(ingest_arr) < 3:
+    def _add_measurement_from_dict(self, m):
+        meas = {}
+        for k, v in m.items():
+            # pass the whole measure
+            col, value = self.process(k, m, self.measurement_dispatch)
+            if col is not None:
+                meas[col] = value
+
+        self._append_measurement(
+            meas.get('ingest_id'),
+            meas.get('value'),
+            meas.get('datetime'),
+            meas.get('lon', None),
+            meas.get('lat', None),
+            m.get('fetchlogs_id', self.fetchlogs_id),
+        )
+
+    def _append_measurement(self, ingest_id, value, datetime, lon, lat, fetchlogs_id):
+        if ingest_id is None:
+            raise Exception('Missing ingest id')
+        # parse the ingest id here, source-source_id-measurand
+        source_name, _, rest = ingest_id.partition('-')
+        rest, _, measurand = rest.rpartition('-')
+        if not rest:
             logger.warning(f'Not enough information in ingest-id: `{ingest_id}`')
             return
+        # the stored nodes are matched on the first segment of the
+        # source id so keep using that, see add_node
+        source_id = rest.partition('-')[0]
 
-        source_name = ingest_arr[0]
-        source_id = ingest_arr[1]
-        measurand = ingest_arr[2]
+        # only a handful of distinct sources and measurands show up
+        # in a batch so share one string for each of them
+        source_name = sys.intern(source_name)
+        measurand = sys.intern(measurand)
 
-        if not None in [ingest_id, datetime, source_name, source_id, measurand]:
+        # the ingest id parts are always strings at this point
+        if datetime is not None:
             self.measurements.append([ingest_id, source_name, source_id, measurand, value, datetime, lon, lat, fetchlogs_id])
 
 
@@ -535,21 +672,6 @@ def create_staging_table(cursor):
 		table="TEMP TABLE" if settings.USE_TEMP_TABLES else 'TABLE'
 	))
 
-def write_csv(cursor, data, table, columns):
-    fields = ",".join(columns)
-    sio = StringIO()
-    writer = csv.DictWriter(sio, columns)
-    writer.writerows(data)
-    sio.seek(0)
-    cursor.copy_expert(
-        f"""
-        copy {table} ({fields}) from stdin with csv;
-        """,
-        sio,
-    )
-    logger.debug(f"table: {table}; rowcount: {cursor.rowcount}")
-
-
 def load_metadata_bucketscan(count=100):
     paginator = s3c.get_paginator("list_objects_v2")
     for page in paginator.paginate(
@@ -710,10 +832,72 @@ def submit_file_error(key, e):
             )
 
 
-def to_tsv(row):
-    tsv = "\t".join(map(clean_csv_value, row)) + "\n"
-    return tsv
-    return ""
+# binary COPY framing, see the COPY docs for the file format
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+COPY_NULL = struct.pack(">i", -1)
+# precompiled length prefixed fields
+INT32 = struct.Struct(">i")
+FLOAT8 = struct.Struct(">id")
+INT4 = struct.Struct(">ii")
+INT8 = struct.Struct(">iq")
+
+
+def binary_text(value):
+    if value is None or value == "":
+        return COPY_NULL
+    data = str(value).encode("utf-8")
+    return INT32.pack(len(data)) + data
+
+
+def binary_float8(value):
+    if value is None or value == "":
+        return COPY_NULL
+    return FLOAT8.pack(8, float(value))
+
+
+def binary_int4(value):
+    if value is None or value == "":
+        return COPY_NULL
+    return INT4.pack(4, int(value))
+
+
+def binary_timestamptz(value):
+    if value is None:
+        return COPY_NULL
+    # microseconds since the postgres epoch
+    delta = value - PG_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return INT8.pack(8, micros)
+
+
+def to_copy_binary(rows, chunk_size: int = 1024 * 1024):
+    """
+    Encode measurement rows for COPY staging_measurements in the binary
+    format so that values and timestamps are not formatted as text only
+    to be parsed again by the server
+    """
+    buf = bytearray(COPY_HEADER)
+    for (
+        ingest_id, source_name, source_id, measurand,
+        value, dt, lon, lat, fetchlogs_id
+    ) in rows:
+        buf += b"\x00\x09"
+        buf += binary_text(ingest_id)
+        buf += binary_text(source_name)
+        buf += binary_text(source_id)
+        buf += binary_text(measurand)
+        buf += binary_float8(value)
+        buf += binary_timestamptz(dt)
+        buf += binary_float8(lon)
+        buf += binary_float8(lat)
+        buf += binary_int4(fetchlogs_id)
+        if len(buf) >= chunk_size:
+            yield bytes(buf)
+            buf.clear()
+    buf += COPY_TRAILER
+    yield bytes(buf)
 
 
 def load_measurements_file(fetchlogs_id: int):
@@ -4,15 +4,23 @@ import sys
 from pathlib import Path
 import logging
 from urllib.parse import unquote_plus
-import gzip
-import uuid
+import zlib
+import secrets
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
 
 import boto3
 import re
-from io import StringIO
 import psycopg2
 # import typer
 
+try:
+    # ISA-L based gzip is several times faster at inflating
+    from isal.igzip import open as gzip_open
+except ImportError:
+    from gzip import open as gzip_open
+
 from .settings import settings
 
 # app = typer.Typer()
@@ -24,23 +32,59 @@ cw = boto3.client("cloudwatch")
 
 logger = logging.getLogger('utils')
 
+_RE_S3_URI = re.compile(r"s3://[a-zA-Z]+[a-zA-Z0-9_-]+/[a-zA-Z]+")
+# the literal start of an anchored key pattern, e.g. ^realtime-gzipped/
+_RE_LITERAL_PREFIX = re.compile(r"\^([a-zA-Z0-9/_-]+)")
+# the single character escapes of a postgres E'' string
+_E_STRING_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+# translation table used to escape values for the COPY text format
+_CSV_TRANS = str.maketrans({
+    "\\": "\\\\",
+    "\n": "\\n",
+    "\r": "\\r",
+    "\t": " ",
+})
+
+# units that need to be normalized, see fix_units
+UNITS = {
+    "μg/m3": "µg/m³",
+    "µg/m3": "µg/m³",
+    "μg/m³": "µg/m³",
+}
+
+# keys starting with these could be local files
+LOCAL_PREFIXES = ("/", "./", "../")
+CSV_SUFFIXES = (".csv", ".csv.gz")
+JSON_SUFFIXES = (".json", ".json.gz", ".ndjson", ".ndjson.gz")
+NDJSON_SUFFIXES = (".ndjson", ".ndjson.gz")
+
+# options for the connections that load files, the files can be reloaded
+# from fetchlogs so we do not need to wait for the wal flush on commit
+INGEST_OPTIONS = "-c synchronous_commit=off"
+
 
 class StringIteratorIO(io.TextIOBase):
     def __init__(self, iter):
         self._iter = iter
         self._buff = ""
+        self._pos = 0
 
     def readable(self):
         return True
 
     def _read1(self, n=None):
-        while not self._buff:
+        # keep an offset into the current chunk rather than
+        # slicing off (and copying) the unread remainder each time
+        while self._pos >= len(self._buff):
             try:
                 self._buff = next(self._iter)
+                self._pos = 0
             except StopIteration:
-                break
-        ret = self._buff[:n]
-        self._buff = self._buff[len(ret):]
+                return ""
+        end = len(self._buff) if n is None else self._pos + n
+        ret = self._buff[self._pos:end]
+        self._pos += len(ret)
         return ret
 
     def read(self, n=None):
@@ -107,12 +151,98 @@ def put_metric(
 def clean_csv_value(value):
     if value is None or value == "":
         return r"\N"
-    return str(value).replace("\n", "\\n").replace("\t", " ")
+    if isinstance(value, (int, float)):
+        return str(value)
+    return str(value).translate(_CSV_TRANS)
+
+
+class PipeReader:
+    """
+    Read end of a pipe_reader pipe. Instead of returning EOF after the
+    producer failed it raises the producer error, so the consumer aborts
+    (copy_expert sends a CopyFail, upload_fileobj abandons the upload)
+    rather than finishing with truncated data
+    """
+    def __init__(self, f, errors):
+        self.f = f
+        self.errors = errors
+
+    def _check(self, data):
+        if not data and self.errors:
+            raise self.errors[0]
+        return data
+
+    def read(self, size: int = -1):
+        return self._check(self.f.read(size))
+
+    def readline(self, size: int = -1):
+        return self._check(self.f.readline(size))
+
+
+@contextmanager
+def pipe_reader(chunks, mode: str = "r"):
+    """
+    Write the chunks into a pipe from a background thread and yield a
+    reader for the other end of that pipe. This lets the consumer (e.g.
+    copy_expert) send data while the rest of it is still being produced.
+    An error raised while producing is raised from the reader in place
+    of the end of the data
+    """
+    binary = "b" in mode
+    encoding = None if binary else "utf-8"
+    r, w = os.pipe()
+    errors = []
+
+    def produce():
+        f = os.fdopen(w, "wb" if binary else "w", encoding=encoding)
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+        except Exception as e:
+            # record the error before closing so the reader never
+            # sees the end of the pipe without it
+            errors.append(e)
+        finally:
+            try:
+                f.close()
+            except Exception as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    with os.fdopen(r, mode, encoding=encoding) as f:
+        yield PipeReader(f, errors)
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def write_csv(cursor, data, table, columns):
+    """Copy a list of dicts into table using the COPY text format"""
+    fields = ",".join(columns)
+    rows = (
+        "\t".join(map(clean_csv_value, map(row.get, columns))) + "\n"
+        for row in data
+    )
+    with pipe_reader(rows) as f:
+        cursor.copy_expert(
+            f"""
+            copy {table} ({fields}) from stdin;
+            """,
+            f,
+        )
+    logger.debug(f"table: {table}; rowcount: {cursor.rowcount}")
+
+
+@lru_cache(maxsize=None)
+def read_query(file):
+    """Read (and cache) the raw sql template"""
+    return Path(os.path.join(dir_path, file)).read_text()
 
 
 def get_query(file, **params):
     logger.debug(f"get_query: {file}, params: {params}")
-    query = Path(os.path.join(dir_path, file)).read_text()
+    query = read_query(file)
     if params is not None and len(params) >= 1:
         query = query.format(**params)
     return query
@@ -167,15 +297,7 @@ def get_logs_from_pattern(pattern: str, limit: int = 250):
 
 def fix_units(value: str):
     """Clean up the units field. This was created to deal with mu vs micro issue in the current units list"""
-    units = {
-        "μg/m3": "µg/m³",
-        "µg/m3": "µg/m³",
-        "μg/m³": "µg/m³",
-    }
-    if value in units.keys():
-        return units[value]
-    else:
-        return value
+    return UNITS.get(value, value)
 
 
 def check_if_done(cursor, key):
@@ -213,21 +335,26 @@ def check_if_done(cursor, key):
     return False
 
 
+def split_s3_uri(key: str):
+	"""Split s3://bucket/key into a (bucket, '/', key) tuple"""
+	# not using urlsplit since ? and # are valid in s3 keys
+	return key[len("s3://"):].partition("/")
+
+
 def deconstruct_path(key: str):
-	is_local = os.path.isfile(key)
-	is_s3 = bool(re.match(r"s3://[a-zA-Z]+[a-zA-Z0-9_-]+/[a-zA-Z]+", key))
-	is_csv = bool(re.search(r"\.csv(.gz)?$", key))
-	is_json = bool(re.search(r"\.(nd)?json(.gz)?$", key))
-	is_compressed = bool(re.search(r"\.gz$", key))
+	is_s3 = _RE_S3_URI.match(key) is not None
+	# only stat keys that look like a path, bare keys are s3 keys
+	is_local = key.startswith(LOCAL_PREFIXES) and os.path.isfile(key)
+	is_csv = key.endswith(CSV_SUFFIXES)
+	is_json = key.endswith(JSON_SUFFIXES)
+	is_compressed = key.endswith(".gz")
 	path = {}
 	if is_local:
 		path["local"] = True
 		path["key"] = key
 	elif is_s3:
 		# pull out the bucket name
-		p = key.split("//")[1].split("/")
-		path["bucket"] = p.pop(0)
-		path["key"] = "/".join(p)
+		path["bucket"], _, path["key"] = split_s3_uri(key)
 	else:
 		# use the current bucket from settings
 		path["bucket"] = settings.ETL_BUCKET
@@ -244,23 +371,23 @@ def get_data(key: str):
 	# /key (assume local)
 	# or no source
 	# key (no forward slash, assume etl bucket)
-	if re.match(r"local://[a-zA-Z]+", key):
+	is_local = key.startswith("local://")
+	if is_local:
 		key = key.replace("local://", "")
 
-	is_local = os.path.isfile(key)
-	is_s3 = bool(re.match(r"s3://[a-zA-Z]+[a-zA-Z0-9_-]+/[a-zA-Z]+", key))
-	#is_csv = bool(re.search(r"\.csv(.gz)?$", key))
-	#is_json = bool(re.search(r"\.(nd)?json(.gz)?$", key))
-	is_compressed = bool(re.search(r"\.gz$", key))
+	is_s3 = _RE_S3_URI.match(key) is not None
+	# only stat keys that look like a path, bare keys are s3 keys
+	is_local = (is_local or key.startswith(LOCAL_PREFIXES)) and os.path.isfile(key)
+	#is_csv = key.endswith(CSV_SUFFIXES)
+	#is_json = key.endswith(JSON_SUFFIXES)
+	is_compressed = key.endswith(".gz")
 	logger.debug(f"checking - {key}\ns3: {is_s3}; is_local: {is_local}")
 
 	if is_local:
 		return get_file(key)
 	elif is_s3:
 		# pull out the bucket name
-		path = key.split("//")[1].split("/")
-		bucket = path.pop(0)
-		key = "/".join(path)
+		bucket, _, key = split_s3_uri(key)
 	else:
 		# use the current bucket from settings
 		bucket = settings.ETL_BUCKET
@@ -273,38 +400,68 @@ def get_data(key: str):
 		)
 	f = obj["Body"]
 	if is_compressed:
-		return gzip.GzipFile(fileobj=obj["Body"])
+		return gzip_open(obj["Body"], 'rb')
 	else:
 		return obj["Body"]
 
 
 def get_file(filepath: str):
-	is_compressed = bool(re.search(r"\.gz$", filepath))
+	is_compressed = filepath.endswith(".gz")
 	logger.debug(f"streaming local file data from {filepath}")
 	if is_compressed:
-		return gzip.open(filepath, 'rb')
+		return gzip_open(filepath, 'rb')
 	else:
 		return io.open(filepath, "r", encoding="utf-8")
 
 
+class StreamingBodyIO(io.RawIOBase):
+    """Raw io wrapper around a botocore StreamingBody for io.BufferedReader"""
+    def __init__(self, body):
+        self.body = body
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.body.read(len(b))
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def close(self):
+        self.body.close()
+        super().close()
+
+
 def get_object(
         key: str,
         bucket: str = settings.ETL_BUCKET
 ):
+    """
+    Stream the bytes of an object from s3, decompressing gzipped objects
+    as they are read. orjson parses bytes directly so there is no need to
+    decode the content first
+    """
     key = unquote_plus(key)
-    text = ''
     logger.debug(f"Getting {key} from {bucket}")
     obj = s3.get_object(
         Bucket=bucket,
         Key=key,
     )
     body = obj['Body']
-    if str.endswith(key, ".gz"):
-        text = gzip.decompress(body.read()).decode('utf-8')
+    if key.endswith(".gz"):
+        return gzip_open(body, 'rb')
     else:
-        text = body
+        # iterating the raw body yields fixed size chunks, not lines
+        return io.BufferedReader(StreamingBodyIO(body))
+
 
-    return text
+def gzip_chunks(data: str, chunk_size: int = 1024 * 1024):
+    """Gzip a string incrementally, yielding the compressed chunks"""
+    z = zlib.compressobj(9, zlib.DEFLATED, 31)
+    for i in range(0, len(data), chunk_size):
+        yield z.compress(data[i:i + chunk_size].encode("utf-8"))
+    yield z.flush()
 
 
 def put_object(
@@ -312,24 +469,18 @@ def put_object(
         key: str,
         bucket: str = settings.ETL_BUCKET
 ):
-    out = io.BytesIO()
-    with gzip.GzipFile(fileobj=out, mode='wb') as gz:
-        with io.TextIOWrapper(gz, encoding='utf-8') as wrapper:
-            wrapper.write(data)
+    chunks = gzip_chunks(data)
     if settings.DRYRUN:
         filepath = os.path.join(bucket, key)
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
         logger.debug(f"Dry Run: Writing file to local file in {filepath}")
-        txt = open(f"{filepath}", "wb")
-        txt.write(out.getvalue())
-        txt.close()
+        with open(f"{filepath}", "wb") as txt:
+            for chunk in chunks:
+                txt.write(chunk)
     else:
         logger.info(f"Uploading file to {bucket}/{key}")
-        s3.put_object(
-            Bucket=bucket,
-            Key=key,
-            Body=out.getvalue(),
-        )
+        with pipe_reader(chunks, "rb") as body:
+            s3.upload_fileobj(body, bucket, key)
 
 
 def select_object(key: str):
@@ -355,11 +506,10 @@ def select_object(key: str):
             'JSON': {}
         }
         input_serialization = {
-            "JSON": {"Type": "Document"},
+            "JSON": {"Type": "Lines" if key.endswith(NDJSON_SUFFIXES) else "Document"},
             "CompressionType": compression,
         }
 
-    content = ""
     logger.debug(f"Getting object: {key}, {output_serialization}")
     resp = s3.select_object_content(
         Bucket=settings.ETL_BUCKET,
@@ -373,10 +523,14 @@ def select_object(key: str):
         InputSerialization=input_serialization,
         OutputSerialization=output_serialization,
     )
+    # collect the raw chunks and decode once at the end, this avoids
+    # rebuilding the string for every event and a multibyte character
+    # can be split across two events
+    chunks = []
     for event in resp["Payload"]:
         if "Records" in event:
-            content += event["Records"]["Payload"].decode("utf-8")
-    return content
+            chunks.append(event["Records"]["Payload"])
+    return b"".join(chunks).decode("utf-8")
 
 
 def load_errors_summary(days: int = 30):
@@ -506,15 +660,104 @@ def load_success(cursor, keys, message: str = 'success'):
     )
 
 
+def e_string(value: str):
+    """
+    Return the text postgres reads from the string literal E'value', or
+    None when it uses an octal, hex or unicode escape that could stand for
+    any character
+    """
+    out = []
+    chars = iter(value)
+    for c in chars:
+        if c == "\\":
+            c = next(chars, "")
+            if c == "" or c in "01234567xuU":
+                return None
+            c = _E_STRING_ESCAPES.get(c, c)
+        out.append(c)
+    return "".join(out)
+
+
+def pattern_prefix(pattern: str):
+    """Return the literal prefix of an anchored regex pattern, if any"""
+    # the pattern is sent as E'pattern' so \| reaches the regex as |
+    # and only \\| is an escaped | by the time the regex is compiled
+    regex = e_string(pattern)
+    if regex is None:
+        return None
+    m = _RE_LITERAL_PREFIX.match(regex)
+    if m is None:
+        return None
+    # a top level alternation (^abc|def) is not anchored to the prefix,
+    # escaped characters and bracket expressions can not open a group
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == "\\":
+            i += 2
+            continue
+        if in_class:
+            if c == "]":
+                in_class = False
+        elif c == "[":
+            in_class = True
+            # a ] straight after [ or [^ is a literal member
+            if regex[i + 1:i + 2] == "^":
+                i += 1
+            if regex[i + 1:i + 2] == "]":
+                i += 1
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth < 0:
+                return None
+        elif c == "|" and depth == 0:
+            return None
+        i += 1
+    if in_class or depth != 0:
+        return None
+    prefix = m.group(1)
+    if regex[m.end():m.end() + 1] in ("*", "?", "{"):
+        # the last character is quantified and may not be there
+        prefix = prefix[:-1]
+    return prefix or None
+
+
+def like_prefix(prefix: str):
+    """Build a LIKE pattern that matches keys starting with prefix"""
+    return prefix.replace("_", "\\_") + "%"
+
+
 def load_fetchlogs(
         pattern: str,
         limit: int = 250,
         ascending: bool = False,
 ):
+    """
+    Check out a batch of fetchlogs with keys matching pattern. When the
+    pattern starts with a literal prefix (^prefix...) we also filter with
+    LIKE 'prefix%' so that postgres can use a range scan on a
+    text_pattern_ops index on fetchlogs(key) instead of running the regex
+    against every row
+    """
     order = 'ASC' if ascending else 'DESC'
+    prefix = pattern_prefix(pattern)
+    if prefix is None:
+        where = f"key~E'{pattern}'"
+        params = (limit,)
+    elif pattern == f"^{prefix}":
+        where = "key LIKE %s"
+        params = (like_prefix(prefix), limit,)
+    else:
+        where = f"key LIKE %s AND key~E'{pattern}'"
+        params = (like_prefix(prefix), limit,)
+
     conn = psycopg2.connect(settings.DATABASE_WRITE_URL)
     cur = conn.cursor()
-    batch_uuid = uuid.uuid4().hex
+    batch_uuid = secrets.token_hex(16)
     cur.execute(
         f"""
         UPDATE fetchlogs
@@ -524,7 +767,7 @@ def load_fetchlogs(
         FROM (
           SELECT fetchlogs_id
           FROM fetchlogs
-          WHERE key~E'{pattern}'
+          WHERE {where}
           AND NOT has_error
           AND completed_datetime is null
           AND (
@@ -540,7 +783,7 @@ def load_fetchlogs(
         , fetchlogs.key
         , fetchlogs.last_modified;
         """,
-        (batch_uuid, limit,),
+        (batch_uuid, *params),
     )
     rows = cur.fetchall()
     logger.debug(f'Loaded {len(rows)} from fetchlogs using {pattern}/{order}')
@@ -621,27 +864,28 @@ def mark_success(
 def crawl(bucket, prefix):
     paginator = s3.get_paginator("list_objects_v2")
     print(settings.DATABASE_WRITE_URL)
-    f = StringIO()
-    cnt = 0
-    for page in paginator.paginate(
-        Bucket=bucket,
-        Prefix=prefix,
-        PaginationConfig={"PageSize": 1000},
-    ):
-        cnt += 1
-        print(".", end="")
-        try:
-            contents = page["Contents"]
-        except KeyError:
-            print("Done")
-            break
-        for obj in contents:
-            key = obj["Key"]
-            last_modified = obj["LastModified"]
-            if key.endswith('.gz'):
-                f.write(f"{key}\t{last_modified}\n")
-                print(key)
-    f.seek(0)
+
+    # stream the listing into the copy instead of
+    # collecting the whole bucket listing in memory first
+    def rows():
+        for page in paginator.paginate(
+            Bucket=bucket,
+            Prefix=prefix,
+            PaginationConfig={"PageSize": 1000},
+        ):
+            print(".", end="")
+            try:
+                contents = page["Contents"]
+            except KeyError:
+                print("Done")
+                break
+            for obj in contents:
+                key = obj["Key"]
+                last_modified = obj["LastModified"]
+                if key.endswith('.gz'):
+                    print(key)
+                    yield f"{key}\t{last_modified}\n"
+
     with psycopg2.connect(settings.DATABASE_WRITE_URL) as connection:
         connection.set_session(autocommit=True)
         with connection.cursor() as cursor:
@@ -657,7 +901,7 @@ def crawl(bucket, prefix):
                         UPDATE SET
                             last_modified=EXCLUDED.last_modified;
                 """,
-                f,
+                StringIteratorIO(rows()),
             )
 
 
@@ -1,23 +1,11 @@
-import os
-import sys
-import orjson
-import psycopg2
 import logging
-from time import time
-import csv
 
 
 from ingest.lcsV2 import (
     IngestClient,
-    load_measurements,
     load_measurements_db,
 )
 
-from ingest.utils import (
-    select_object,
-    get_file,
-)
-
 logger = logging.getLogger('handler')
 
 logging.basicConfig(
@@ -40,16 +28,16 @@ rows = [
     [1, '/home/christian/Downloads/1610335354.csv', '2022-01-01']
     ]
 
+if __name__ == '__main__':
+    # local files
+    #load_measurements_db(pattern = '^/home/christian/.*\\.(csv|json)')
+    # remote files, make sure it can at least read it
+    load_measurements_db()
 
-# local files
-#load_measurements_db(pattern = '^/home/christian/.*\\.(csv|json)')
-# remote files, make sure it can at least read it
-load_measurements_db()
-
-## client based methods
-#client = IngestClient()
-#client.load_keys(rows)
-#client.dump()
+    ## client based methods
+    #client = IngestClient()
+    #client.load_keys(rows)
+    #client.dump()
 
 # #client.load(data)
 # client.load_metadata(data['meta'])
@@ -0,0 +1,19 @@
+import os
+
+# the unit tests do not touch the database or the buckets but the
+# settings and an aws region are required when the ingest modules
+# are imported
+for name, value in {
+    "DATABASE_READ_USER": "test",
+    "DATABASE_WRITE_USER": "test",
+    "DATABASE_READ_PASSWORD": "test",
+    "DATABASE_WRITE_PASSWORD": "test",
+    "DATABASE_DB": "test",
+    "DATABASE_HOST": "localhost",
+    "DATABASE_PORT": "5432",
+    "FASTAPI_URL": "http://localhost",
+    "FETCH_BUCKET": "test",
+    "ETL_BUCKET": "test",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,112 @@
+import struct
+from datetime import datetime, timedelta, timezone
+
+from ingest.lcsV2 import IngestClient, to_copy_binary
+
+
+def test_add_measurement_dashed_ingest_id():
+    client = IngestClient(fetchlogs_id=1)
+    client.add_measurement(
+        ["provider-abc-def-ghi-pm25", "1.5", "2024-01-01T00:00:00Z"]
+    )
+    assert len(client.measurements) == 1
+    ingest_id, source_name, source_id, measurand = client.measurements[0][:4]
+    assert ingest_id == "provider-abc-def-ghi-pm25"
+    assert source_name == "provider"
+    # stored nodes are matched on the first segment of the source id
+    assert source_id == "abc"
+    assert measurand == "pm25"
+
+
+def test_add_measurement_ingest_id():
+    client = IngestClient(fetchlogs_id=1)
+    client.add_measurement(["provider-abc-pm25", "1.5", "2024-01-01T00:00:00Z"])
+    assert client.measurements[0][1:4] == ["provider", "abc", "pm25"]
+
+
+def test_add_measurement_short_ingest_id():
+    client = IngestClient(fetchlogs_id=1)
+    client.add_measurement(["provider-pm25", "1.5", "2024-01-01T00:00:00Z"])
+    assert client.measurements == []
+
+
+def test_add_node_dashed_ingest_id():
+    client = IngestClient(fetchlogs_id=1)
+    client.add_node({"sensor_node_id": "provider-abc-def"})
+    assert len(client.nodes) == 1
+    assert client.nodes[0]["source_name"] == "provider"
+    assert client.nodes[0]["source_id"] == "abc"
+
+
+def read_copy_binary(data):
+    """Decode a binary COPY stream into rows of raw field bytes"""
+    assert data[:11] == b"PGCOPY\n\xff\r\n\x00"
+    flags, extension = struct.unpack(">ii", data[11:19])
+    assert flags == 0
+    assert extension == 0
+    pos = 19
+    rows = []
+    while True:
+        (count,) = struct.unpack(">h", data[pos:pos + 2])
+        pos += 2
+        if count == -1:
+            break
+        row = []
+        for _ in range(count):
+            (length,) = struct.unpack(">i", data[pos:pos + 4])
+            pos += 4
+            if length == -1:
+                row.append(None)
+            else:
+                row.append(data[pos:pos + length])
+                pos += length
+        rows.append(row)
+    # nothing follows the trailer
+    assert pos == len(data)
+    return rows
+
+
+def test_to_copy_binary():
+    dt = datetime(2024, 1, 2, 3, 4, 5, 678901, tzinfo=timezone.utc)
+    rows = [
+        ["provider-abc-pm25", "provider", "abc", "pm25", 1.5, dt, -71.25, 42.5, 7],
+        ["provider-abc-pm25", "provider", "abc", "pm25", "2", dt, None, None, None],
+    ]
+    data = b"".join(to_copy_binary(rows))
+    decoded = read_copy_binary(data)
+    assert len(decoded) == 2
+
+    first, second = decoded
+    assert len(first) == 9
+    assert [f.decode("utf-8") for f in first[:4]] == [
+        "provider-abc-pm25", "provider", "abc", "pm25"
+    ]
+    assert struct.unpack(">d", first[4]) == (1.5,)
+    assert struct.unpack(">d", first[6]) == (-71.25,)
+    assert struct.unpack(">d", first[7]) == (42.5,)
+    assert struct.unpack(">i", first[8]) == (7,)
+
+    # microseconds since 2000-01-01 00:00:00 UTC
+    (micros,) = struct.unpack(">q", first[5])
+    epoch = datetime(2000, 1, 1, tzinfo=timezone.utc)
+    assert epoch + timedelta(microseconds=micros) == dt
+
+    assert struct.unpack(">d", second[4]) == (2.0,)
+    assert second[6:] == [None, None, None]
+
+
+def test_to_copy_binary_timestamp_offset():
+    # the timestamp is converted to utc before it is encoded
+    dt = datetime(1999, 12, 31, 19, 0, tzinfo=timezone(timedelta(hours=-5)))
+    rows = [["a-b-c", "a", "b", "c", 1, dt, None, None, 1]]
+    (row,) = read_copy_binary(b"".join(to_copy_binary(rows)))
+    assert struct.unpack(">q", row[5]) == (0,)
+
+
+def test_to_copy_binary_chunks():
+    dt = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rows = [["a-b-c", "a", "b", "c", i, dt, None, None, 1] for i in range(50)]
+    chunks = list(to_copy_binary(rows, chunk_size=256))
+    assert len(chunks) > 1
+    decoded = read_copy_binary(b"".join(chunks))
+    assert [struct.unpack(">d", r[4])[0] for r in decoded] == list(range(50))
@@ -0,0 +1,81 @@
+import pytest
+
+from ingest.utils import e_string, like_prefix, pattern_prefix
+
+
+@pytest.mark.parametrize("pattern,prefix", [
+    # the patterns the loaders use
+    ("^realtime-gzipped/.*\\.ndjson.gz$", "realtime-gzipped/"),
+    ("^lcs-etl-pipeline/measures/.*\\.csv", "lcs-etl-pipeline/measures/"),
+    ("^lcs-etl-pipeline/measures/.*\\.(csv|json)", "lcs-etl-pipeline/measures/"),
+    ("^lcs-etl-pipeline/stations/", "lcs-etl-pipeline/stations/"),
+    # not anchored
+    ("lcs-etl-pipeline/stations/", None),
+    # no literal start
+    ("^.*\\.csv", None),
+    # a quantified last character may be missing
+    ("^abc*", "ab"),
+    ("^abc?d", "ab"),
+    ("^abc{0,2}", "ab"),
+    ("^a*", None),
+    ("^abc+", "abc"),
+])
+def test_pattern_prefix(pattern, prefix):
+    assert pattern_prefix(pattern) == prefix
+
+
+@pytest.mark.parametrize("pattern,prefix", [
+    ("^abc|def", None),
+    ("^abc/.*x|def", None),
+    ("^a(b|c)", "a"),
+    ("^abc/(x|y)/(z|w)", "abc/"),
+    # unbalanced groups are left to the regex
+    ("^ab)|c", None),
+    ("^ab(c", None),
+])
+def test_pattern_prefix_alternation(pattern, prefix):
+    assert pattern_prefix(pattern) == prefix
+
+
+@pytest.mark.parametrize("pattern,prefix", [
+    # E'' drops the backslash so these reach the regex unescaped
+    ("^abc\\|def", None),
+    ("^abc\\(x|def", None),
+    ("^abc\\[|]def", "abc"),
+    # \\ reaches the regex as a single backslash that escapes the next one
+    ("^abc\\\\|def", "abc"),
+    ("^abc\\\\(x|def", None),
+    ("^abc\\\\[|def", None),
+    # escapes that could be any character are not guessed at
+    ("^abc\\174def", None),
+    ("^abc\\x7cdef", None),
+    ("^abc\\u007cdef", None),
+    ("^abc\\", None),
+])
+def test_pattern_prefix_escapes(pattern, prefix):
+    assert pattern_prefix(pattern) == prefix
+
+
+@pytest.mark.parametrize("pattern,prefix", [
+    ("^abc[|]def", "abc"),
+    ("^abc[(]x|def", None),
+    ("^abc[)(]x", "abc"),
+    ("^abc[]|]x", "abc"),
+    ("^abc[^]|]x", "abc"),
+    ("^abc[\\\\]|]x", "abc"),
+    ("^abc[|", None),
+])
+def test_pattern_prefix_brackets(pattern, prefix):
+    assert pattern_prefix(pattern) == prefix
+
+
+def test_e_string():
+    assert e_string("^a\\.b") == "^a.b"
+    assert e_string("a\\\\b") == "a\\b"
+    assert e_string("a\\tb") == "a\tb"
+    assert e_string("a\\101") is None
+
+
+def test_like_prefix():
+    assert like_prefix("realtime-gzipped/") == "realtime-gzipped/%"
+    assert like_prefix("lcs_etl/") == "lcs\\_etl/%"